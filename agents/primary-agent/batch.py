@@ -0,0 +1,112 @@
+"""Bulk query scheduling for `POST /primary-agent/batch`.
+
+Input is JSONL with one query per line. The query text is read from `query`,
+`body` or `title`, so a file like `requests.jsonl` works as is. The id is read
+from `id` or `request_id`; lines without one get `line-<n>`. `limit` and
+`alpha` are optional and are coerced to int and float.
+
+Identical queries (same text, limit and alpha) are answered once, and the
+result is fanned out to every id that asked for it. At most `concurrency`
+distinct queries run at a time. Result lines are yielded in completion order,
+not input order. Each answer is a JSON body that is spliced into its result
+line without being re-parsed.
+"""
+import asyncio
+import json
+import logging
+from typing import AsyncIterator, Awaitable, Callable, Dict, List, Tuple
+
+import orjson
+from fastapi import HTTPException
+
+logger = logging.getLogger(__name__)
+
+BatchKey = Tuple[str, int, float]
+
+
+def _number(record: dict, field: str, cast, default, n: int):
+    """Coerces `limit`/`alpha` so `"0.5"` and `0.5` share a de-duplication key."""
+    value = record.get(field, default)
+    try:
+        if isinstance(value, bool):
+            raise ValueError
+        number = cast(float(value))
+        if cast is int and number != float(value):
+            raise ValueError
+    except (TypeError, ValueError, OverflowError):
+        raise HTTPException(status_code=400, detail=f"Line {n}: {field} must be {'an integer' if cast is int else 'a number'}, got {value!r}")
+    return number
+
+
+def parse_batch_lines(text: str) -> List[dict]:
+    """Parses a JSONL batch into `{"id", "query", "limit", "alpha"}` items.
+
+    Everything is validated here, before the streamed 200 response starts, so
+    bad input is reported as a 400 rather than a truncated stream.
+    """
+    items = []
+    for n, line in enumerate(text.splitlines(), start=1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            record = json.loads(line)
+        except json.JSONDecodeError as e:
+            raise HTTPException(status_code=400, detail=f"Invalid JSON on line {n}: {e}")
+        if not isinstance(record, dict):
+            raise HTTPException(status_code=400, detail=f"Line {n} must be a JSON object")
+        query = record.get("query") or record.get("body") or record.get("title")
+        if not isinstance(query, str) or not query.strip():
+            raise HTTPException(status_code=400, detail=f"Line {n} has no query string")
+        limit = _number(record, "limit", int, 5, n)
+        alpha = _number(record, "alpha", float, 0.5, n)
+        if limit < 1 or not 0 <= alpha <= 1:
+            raise HTTPException(status_code=400, detail=f"Line {n}: limit must be >= 1 and alpha in [0, 1]")
+        items.append({
+            "id": str(record.get("id") or record.get("request_id") or f"line-{n}"),
+            "query": query,
+            "limit": limit,
+            "alpha": alpha,
+        })
+    return items
+
+
+async def run_batch(
+    items: List[dict],
+    answer: Callable[[dict], Awaitable[bytes]],
+    concurrency: int,
+) -> AsyncIterator[bytes]:
+    """Runs `answer` over de-duplicated items and yields JSONL result lines as they finish."""
+    groups: Dict[BatchKey, List[dict]] = {}
+    for item in items:
+        key = (" ".join(item["query"].split()), item["limit"], item["alpha"])
+        groups.setdefault(key, []).append(item)
+    logger.info(f"Batch of {len(items)} queries, {len(groups)} distinct, concurrency {concurrency}")
+
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def run(key: BatchKey):
+        async with semaphore:
+            try:
+                return key, await answer(groups[key][0]), None
+            except HTTPException as e:
+                return key, None, str(e.detail)
+            except Exception as e:
+                return key, None, str(e)
+
+    tasks = [asyncio.ensure_future(run(key)) for key in groups]
+    try:
+        for next_done in asyncio.as_completed(tasks):
+            key, result, error = await next_done
+            for item in groups[key]:
+                line = {"id": item["id"], "query": item["query"]}
+                if error is None:
+                    # `{"id":..,"query":..}` with the last brace swapped for the raw result
+                    yield orjson.dumps(line)[:-1] + b',"result":' + result + b"}\n"
+                else:
+                    line["error"] = error
+                    yield orjson.dumps(line) + b"\n"
+    finally:
+        # Client went away or the batch finished: drop anything still queued.
+        for task in tasks:
+            task.cancel()
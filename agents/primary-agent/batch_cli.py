@@ -0,0 +1,85 @@
+"""Runs a JSONL file of queries through `POST /primary-agent/batch`.
+
+    python batch_cli.py questions.jsonl results.jsonl --url http://<host>/primary-agent/batch
+
+Results are appended to the output file as they stream back. The output file
+is also the checkpoint: on a rerun, ids that already have a result are
+skipped, and ids that only have an error are retried. When an id appears more
+than once, its last line is the current one.
+"""
+import argparse
+import json
+import os
+import sys
+
+import httpx
+
+
+def load_items(path: str):
+    """Reads input records and pins each one to a stable id."""
+    items = []
+    with open(path, encoding="utf-8") as f:
+        for n, line in enumerate(f, start=1):
+            line = line.strip()
+            if not line:
+                continue
+            record = json.loads(line)
+            record["id"] = str(record.get("id") or record.get("request_id") or f"line-{n}")
+            items.append(record)
+    return items
+
+
+def load_completed(path: str):
+    """Ids whose latest line in the output file is a successful result."""
+    completed = set()
+    if not os.path.exists(path):
+        return completed
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue  # a line cut short by an interrupted run
+            if "result" in record:
+                completed.add(record["id"])
+            else:
+                completed.discard(record["id"])
+    return completed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("input", help="JSONL file with one query per line")
+    parser.add_argument("output", help="JSONL file that results are appended to")
+    parser.add_argument("--url", default="http://localhost:8007/primary-agent/batch")
+    parser.add_argument("--chunk-size", type=int, default=200, help="queries sent per batch request")
+    args = parser.parse_args()
+
+    items = load_items(args.input)
+    completed = load_completed(args.output)
+    pending = [item for item in items if item["id"] not in completed]
+    print(f"{len(items)} queries, {len(items) - len(pending)} already done, {len(pending)} to run", file=sys.stderr)
+
+    failed = 0
+    with open(args.output, "a", encoding="utf-8") as out, httpx.Client(timeout=None) as client:
+        for start in range(0, len(pending), args.chunk_size):
+            chunk = pending[start:start + args.chunk_size]
+            body = "".join(json.dumps(item, ensure_ascii=False) + "\n" for item in chunk)
+            with client.stream("POST", args.url, content=body.encode("utf-8"),
+                               headers={"Content-Type": "application/x-ndjson"}) as response:
+                response.raise_for_status()
+                for line in response.iter_lines():
+                    if not line.strip():
+                        continue
+                    out.write(line + "\n")
+                    out.flush()
+                    failed += "error" in json.loads(line)
+            print(f"{min(start + args.chunk_size, len(pending))}/{len(pending)} done", file=sys.stderr)
+
+    if failed:
+        print(f"{failed} queries failed; rerun the same command to retry them", file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,14 +1,20 @@
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import ORJSONResponse, Response, StreamingResponse
 from pydantic import BaseModel
-from typing import Optional
+from typing import List, Optional
+from brotli_asgi import BrotliMiddleware
 import httpx
+import orjson
 import uvicorn
 import os
 import logging
-import asyncio
-from openai import OpenAI
 from dotenv import load_dotenv
 
+from llm_gateway import gateway_from_env
+from batch import parse_batch_lines, run_batch
+from diagnostics import ServerTimingMiddleware, install_debug_routes, record_downstream_timing, stage
+from generation import GenerationProfile, classifier_complete, parse_classifier_output
+
 from opentelemetry import trace
 from opentelemetry.sdk.trace import TracerProvider
 from opentelemetry.sdk.resources import SERVICE_NAME, Resource
@@ -34,24 +40,51 @@ span_processor = BatchSpanProcessor(jaeger_exporter)
 trace_provider.add_span_processor(span_processor)
 trace.set_tracer_provider(trace_provider)
 
-app = FastAPI()
+app = FastAPI(default_response_class=ORJSONResponse)
 # Automatic Instrumentation for FastAPI and httpx
 HTTPXClientInstrumentor().instrument()
 FastAPIInstrumentor.instrument_app(app, tracer_provider=trace_provider)
+app.add_middleware(ServerTimingMiddleware)
+# Negotiates br or gzip with clients at the ingress-facing service. The batch stream is
+# left uncompressed: the gzip fallback buffers streamed bodies until they end.
+app.add_middleware(BrotliMiddleware, minimum_size=500, gzip_fallback=True,
+                   excluded_handlers=[r"^/primary-agent/batch"])
+install_debug_routes(app)
 
 
 # Configuration
-RUNPOD_ENDPOINT_ID = os.getenv("RUNPOD_ENDPOINT_ID")
-RUNPOD_API_KEY = os.getenv("RUNPOD_API_KEY")
-RUNPOD_BASE_URL = f"https://api.runpod.ai/v2/{RUNPOD_ENDPOINT_ID}/openai/v1"
 RAG_SERVICE_URL = os.getenv("RAG_SERVICE_URL", "http://rag-agent.rag-agent.svc.cluster.local:65003/process-query")
+BATCH_CONCURRENCY = int(os.getenv("BATCH_CONCURRENCY", 4))
+
+# Shared LLM client: concurrency limits, retries, hedging and failover across backends
+llm_gateway = gateway_from_env()
 
-client = OpenAI(base_url=RUNPOD_BASE_URL, api_key=RUNPOD_API_KEY)
+@app.on_event("shutdown")
+async def close_llm_gateway():
+    await llm_gateway.aclose()
+
+# Generation profiles for each LLM call site
+CLASSIFIER_PROFILE = GenerationProfile(
+    name="primary-classifier",
+    model="Qwen/Qwen2.5-7B-Instruct",
+    max_tokens=256,
+    temperature=0.3,
+    stop_when=classifier_complete,  # hang up as soon as the model commits to USE_RAG
+)
 
 class QueryRequest(BaseModel):
     query: str
     limit: int = 5
     alpha: float = 0.5
+    include_attempts: bool = False  # ask the RAG agent for per-attempt details
+    include_response: bool = False  # also return the deprecated `response` field
+
+class AttemptLog(BaseModel):
+    attempt: int
+    query_used: str
+    reasoning: str
+    answer: str
+    refined_query: Optional[str]
 
 class RAGResponse(BaseModel):
     status: str
@@ -59,72 +92,92 @@ class RAGResponse(BaseModel):
     answer: Optional[str]
     refined_query: Optional[str]
     attempts: int
-    response: str
+    response: Optional[str] = None  # deprecated alias of `answer`, only sent with include_response; to be removed
+    attempt_logs: Optional[List[AttemptLog]] = None
 
-async def call_runpod(prompt: str) -> str:
+async def call_runpod(prompt: str, profile: GenerationProfile, batch: bool = False) -> str:
     """Calls RunPod API to generate a response."""
     try:
-            logger.info("Calling RunPod API (Primary Agent)")
-            response = await asyncio.to_thread(
-                lambda: client.chat.completions.create(
-                    model="Qwen/Qwen2.5-7B-Instruct", 
-                    messages=[{"role": "user", "content": prompt}],
-                    temperature=0.6,
-                    top_p=0.8,
-                    max_tokens=700,
-                )
+            logger.info(f"Calling RunPod API (Primary Agent, profile={profile.name})")
+            result = await llm_gateway.chat(
+                messages=[{"role": "user", "content": prompt}],
+                batch=batch,
+                **profile.params(),
             )
-
-            result = response.choices[0].message.content
             logger.info("RunPod API call successful")
             return result
     except Exception as e:
             logger.error(f"Error in RunPod API call (Primary Agent): {e}")
             raise HTTPException(status_code=500, detail="RunPod API error")
 
-async def call_rag_service(request: QueryRequest):
+async def call_rag_service(request: QueryRequest, batch: bool = False) -> bytes:
+    """Returns the RAG agent's JSON body as-is; it is proxied without decoding."""
+    # Lets the RAG agent route batch work through its capped LLM lane
+    headers = {"X-Request-Priority": "batch"} if batch else {}
     async with httpx.AsyncClient() as client:
         try:
             logger.info("Calling RAG service")
-            response = await client.post(RAG_SERVICE_URL, json=request.dict(), timeout=None)
+            response = await client.post(RAG_SERVICE_URL, json=request.dict(), headers=headers, timeout=None)
             response.raise_for_status()
+            record_downstream_timing("rag", response.headers)
             logger.info("Successfully received response from RAG service")
-            return response.json()
+            return response.content
         except Exception as e:
             logger.error(f"Error calling RAG service: {e}")
             raise HTTPException(status_code=500, detail=f"Error calling RAG service: {str(e)}")
 
-@app.post("/primary-agent", response_model=RAGResponse)
-async def primary_agent_endpoint(request: QueryRequest):
+async def answer_query(request: QueryRequest, batch: bool = False) -> bytes:
+        """Classifies the query and answers it directly or through the RAG service, as a JSON body."""
         logger.info(f"Received request: {request.query}")
-        prompt = f"""
+        with stage("format_prompt"):
+            prompt = f"""
             You are an intelligent AI assistant specialized in answering user queries.
 
             **Instructions:**
-            1. If the user's question is related to Vietnamese traffic law, respond exactly with "USE_RAG".
-            2. If the question is trivial, provide a direct answer.
-            3. Otherwise, provide a concise and accurate response.
+            1. If the user's question is related to Vietnamese traffic law, respond exactly with "USE_RAG" and nothing else.
+            2. Otherwise, respond with "ANSWER: " followed by a concise and accurate answer in at most a few sentences.
 
             **User's Question:** "{request.query}"
         """
-        response = await call_runpod(prompt)
-        response = response.strip()
+        with stage("llm_classify"):
+            response = await call_runpod(prompt, CLASSIFIER_PROFILE, batch=batch)
+        use_rag, response = parse_classifier_output(response)
         
-        if "USE_RAG" in response:
+        if use_rag:
             logger.info("Query classified as requiring RAG service")
-            rag_response = await call_rag_service(request)
+            with stage("rag_service"):
+                rag_response = await call_rag_service(request, batch=batch)
             return rag_response
         else:
             logger.info("Returning direct response")
-            return {
+            body = {
                 "status": "direct_answer",
                 "reasoning": "",
                 "answer": response,
                 "refined_query": None,
                 "attempts": 1,
-                "response": response
             }
-        
+            if request.include_response:
+                body["response"] = response
+            return orjson.dumps(body)
+
+@app.post("/primary-agent", response_model=RAGResponse)
+async def primary_agent_endpoint(request: QueryRequest):
+        return Response(content=await answer_query(request), media_type="application/json")
+
+@app.post("/primary-agent/batch")
+async def primary_agent_batch(request: Request):
+        """Answers a JSONL batch of queries, streaming JSONL results as they complete."""
+        items = parse_batch_lines((await request.body()).decode("utf-8"))
+
+        async def answer(item: dict) -> bytes:
+            fields = {k: v for k, v in item.items() if k != "id"}
+            return await answer_query(QueryRequest(**fields), batch=True)
+
+        return StreamingResponse(
+            run_batch(items, answer, BATCH_CONCURRENCY),
+            media_type="application/x-ndjson",
+        )
 
 if __name__ == "__main__":
     uvicorn.run(app, host="0.0.0.0", port=8007)
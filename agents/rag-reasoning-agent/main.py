@@ -1,15 +1,18 @@
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Header
+from fastapi.responses import ORJSONResponse
 from pydantic import BaseModel
-from typing import Optional
+from typing import List, Optional
 import httpx
 import uvicorn
 import re
-import asyncio
-from openai import OpenAI
 import os
 import logging
 from dotenv import load_dotenv
 
+from llm_gateway import gateway_from_env
+from diagnostics import ServerTimingMiddleware, install_debug_routes, record_downstream_timing, stage
+from generation import GenerationProfile, rag_answer_complete, strip_answer_tags
+
 from opentelemetry import trace
 from opentelemetry.sdk.trace import TracerProvider
 from opentelemetry.sdk.resources import SERVICE_NAME, Resource
@@ -35,23 +38,46 @@ span_processor = BatchSpanProcessor(jaeger_exporter)
 trace_provider.add_span_processor(span_processor)
 trace.set_tracer_provider(trace_provider)
 
-app = FastAPI()
+app = FastAPI(default_response_class=ORJSONResponse)
 HTTPXClientInstrumentor().instrument()
 FastAPIInstrumentor.instrument_app(app, tracer_provider=trace_provider)
+app.add_middleware(ServerTimingMiddleware)
+install_debug_routes(app)
 
 
 # Configuration
-RUNPOD_ENDPOINT_ID = os.getenv('RUNPOD_ENDPOINT_ID')
-RUNPOD_API_KEY = os.getenv('RUNPOD_API_KEY')
-RUNPOD_BASE_URL = f"https://api.runpod.ai/v2/{RUNPOD_ENDPOINT_ID}/openai/v1"
 CONTEXT_SERVICE_URL = os.getenv("CONTEXT_SERVICE_URL", "http://retrieval.context-retrieval.svc.cluster.local:65002/retrieve-context")
 
-client = OpenAI(base_url=RUNPOD_BASE_URL, api_key=RUNPOD_API_KEY)
+# Shared LLM client: concurrency limits, retries, hedging and failover across backends
+llm_gateway = gateway_from_env()
+
+@app.on_event("shutdown")
+async def close_llm_gateway():
+    await llm_gateway.aclose()
+
+# Generation profiles for each LLM call site
+RAG_ANSWER_PROFILE = GenerationProfile(
+    name="rag-answer",
+    model="deepseek-ai/DeepSeek-R1-Distill-Qwen-7B",
+    max_tokens=700,
+    # No server-side stop: R1 often echoes the <answer> format inside <think>, so
+    # "</answer>" only ends the generation once it follows "</think>"
+    stop_when=rag_answer_complete,
+)
 
 class QueryRequest(BaseModel):
     query: str
     limit: int = 5
     alpha: float = 0.5
+    include_attempts: bool = False  # return per-attempt details in attempt_logs
+    include_response: bool = False  # also return the deprecated `response` field
+
+class AttemptLog(BaseModel):
+    attempt: int
+    query_used: str
+    reasoning: str
+    answer: str
+    refined_query: Optional[str]
 
 class RAGResponse(BaseModel):
     status: str  # "success", "refined_success", "max_retries_exceeded"
@@ -59,23 +85,18 @@ class RAGResponse(BaseModel):
     answer: Optional[str]
     refined_query: Optional[str]
     attempts: int
-    response: str
+    response: Optional[str] = None  # deprecated alias of `answer`, only sent with include_response; to be removed
+    attempt_logs: Optional[List[AttemptLog]] = None
 
-async def call_runpod(prompt: str) -> str:
+async def call_runpod(prompt: str, profile: GenerationProfile, batch: bool = False) -> str:
     """Calls RunPod API to generate a response asynchronously."""
     try:
-            logger.info("Calling RunPod API (RAG Agent)")
-            response = await asyncio.to_thread(
-                lambda: client.chat.completions.create(
-                    model="deepseek-ai/DeepSeek-R1-Distill-Qwen-7B", 
-                    messages=[{"role": "user", "content": prompt}],
-                    temperature=0.6,
-                    top_p=0.8,
-                    max_tokens=700,
-                )
+            logger.info(f"Calling RunPod API (RAG Agent, profile={profile.name})")
+            result = await llm_gateway.chat(
+                messages=[{"role": "user", "content": prompt}],
+                batch=batch,
+                **profile.params(),
             )
-
-            result = response.choices[0].message.content
             logger.info("RunPod API call successful (RAG Agent)")
             return result
     except Exception as e:
@@ -83,20 +104,23 @@ async def call_runpod(prompt: str) -> str:
             raise HTTPException(status_code=500, detail="RunPod API error in RAG Agent")
 
 
-async def fetch_context(query, request):
+async def fetch_context(query, request, batch=False):
+    headers = {"X-Request-Priority": "batch"} if batch else {}
     async with httpx.AsyncClient() as client:
         response = await client.post(
             CONTEXT_SERVICE_URL,
-            json={"query": query, "limit": request.limit, "alpha": request.alpha}
+            json={"query": query, "limit": request.limit, "alpha": request.alpha},
+            headers=headers,
         )
         response.raise_for_status()
+        record_downstream_timing("retrieval", response.headers)
         return response.json().get("context", "")
 
 def extract_response(response: str) -> tuple:
     """Extract components from model response without fallback default strings."""
     parts = response.split("</think>", 1)
     reasoning = parts[0].strip()
-    answer = parts[1].strip() if len(parts) > 1 else ""
+    answer = strip_answer_tags(parts[1]) if len(parts) > 1 else ""
     
     refined_query_match = re.search(r'Refined Query:\s*(.+)', answer, re.IGNORECASE)
     refined_query = refined_query_match.group(1).strip() if refined_query_match else None
@@ -106,8 +130,9 @@ def extract_response(response: str) -> tuple:
     
     return reasoning, answer, None
 
-@app.post("/process-query", response_model=RAGResponse)
-async def process_query(request: QueryRequest):
+@app.post("/process-query", response_model=RAGResponse, response_model_exclude_unset=True)
+async def process_query(request: QueryRequest, x_request_priority: Optional[str] = Header(None)):
+        batch = x_request_priority == "batch"
         original_query = request.query
         query = original_query
         max_retries = 2  # Allow one refine attempt (total attempts = 2)
@@ -116,10 +141,12 @@ async def process_query(request: QueryRequest):
         for attempt in range(max_retries):
                 try:
                     # Get context from the context service
-                    context = await fetch_context(query, request)
+                    with stage("fetch_context"):
+                        context = await fetch_context(query, request, batch=batch)
     
                     # Generate prompt using the provided context and query
-                    prompt = f"""
+                    with stage("format_prompt"):
+                        prompt = f"""
                         You are an expert in Vietnamese Traffic Law. Your task is to analyze the user's question using the provided context and respond exclusively in Vietnamese.
     
                         Take as much time as you need to study the problem carefully and methodically—there is no rush for an immediate answer.
@@ -144,8 +171,10 @@ async def process_query(request: QueryRequest):
                     """
     
                     # Get model response from RunPod
-                    model_response = await call_runpod(prompt)
-                    reasoning, answer, refined_query = extract_response(model_response)
+                    with stage("llm_answer"):
+                        model_response = await call_runpod(prompt, RAG_ANSWER_PROFILE, batch=batch)
+                    with stage("parse_response"):
+                        reasoning, answer, refined_query = extract_response(model_response)
     
                     attempt_logs.append({
                         "attempt": attempt + 1,
@@ -168,14 +197,20 @@ async def process_query(request: QueryRequest):
         final_attempt = attempt_logs[-1]
         status = "success" if final_attempt['attempt'] == 1 else "refined_success" if final_attempt['answer'].strip() else "max_retries_exceeded"
     
-        return RAGResponse(
+        answer = final_attempt['answer'] if final_attempt['answer'].strip() else None
+        fields = dict(
             status=status,
             reasoning=final_attempt['reasoning'],
-            answer=final_attempt['answer'] if final_attempt['answer'].strip() else None,
+            answer=answer,
             refined_query=final_attempt['refined_query'],
             attempts=len(attempt_logs),
-            response=str(attempt_logs)
         )
+        if request.include_response:
+            fields["response"] = answer
+        # attempt_logs repeats every attempt's reasoning and answer, so it is only sent on request
+        if request.include_attempts:
+            fields["attempt_logs"] = attempt_logs
+        return RAGResponse(**fields)
 
 if __name__ == "__main__":
     uvicorn.run(app, host="0.0.0.0", port=8006)
@@ -0,0 +1,149 @@
+"""Exercises the gateway's retry, failover and hedging paths against fake_openai_server.py.
+
+    python check_gateway.py
+
+Starts one fake server per failure mode as a subprocess on local ports, runs
+each scenario through `LLMGateway`, and exits non-zero if any of them
+misbehaves.
+"""
+import asyncio
+import contextlib
+import os
+import subprocess
+import sys
+import time
+
+import httpx
+
+from llm_gateway import Backend, LLMGateway, LLMGatewayError, RetryableLLMError
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+BASE_PORT = int(os.getenv("CHECK_BASE_PORT", 9100))
+MESSAGES = [{"role": "user", "content": "ping"}]
+
+
+@contextlib.contextmanager
+def fake_servers(configs):
+    """Starts a fake server per `{name: env}` entry and yields `{name: base_url}`."""
+    procs, urls = [], {}
+    try:
+        for port, (name, env) in enumerate(configs.items(), start=BASE_PORT):
+            procs.append(subprocess.Popen(
+                [sys.executable, "-m", "uvicorn", "fake_openai_server:app",
+                 "--port", str(port), "--log-level", "warning"],
+                cwd=HERE, env={**os.environ, **env},
+            ))
+            urls[name] = f"http://127.0.0.1:{port}/v1"
+        for url in urls.values():
+            wait_ready(url)
+        yield urls
+    finally:
+        for proc in procs:
+            proc.terminate()
+            proc.wait()
+
+
+def wait_ready(base_url, timeout=20.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            httpx.get(base_url.replace("/v1", "/docs"))
+            return
+        except httpx.TransportError:
+            time.sleep(0.2)
+    raise RuntimeError(f"fake server at {base_url} did not start")
+
+
+def p99(samples):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(round(0.99 * (len(ordered) - 1))))]
+
+
+async def timed_calls(gateway, count, concurrency):
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one():
+        async with semaphore:
+            start = time.monotonic()
+            await gateway.chat(MESSAGES, model="fake")
+            return time.monotonic() - start
+
+    return await asyncio.gather(*(one() for _ in range(count)))
+
+
+async def check_retry(urls):
+    backend = Backend("flaky", urls["flaky"])
+    gateway = LLMGateway([backend], max_retries=6, backoff_base=0.01, failure_threshold=100)
+    try:
+        await timed_calls(gateway, 30, 5)
+    finally:
+        await gateway.aclose()
+    return "30/30 requests succeeded against a 30% error rate"
+
+
+async def check_failover(urls):
+    broken, healthy = Backend("broken", urls["broken"]), Backend("healthy", urls["healthy"])
+    gateway = LLMGateway([broken, healthy], max_retries=1, backoff_base=0.01, failure_threshold=3)
+    gateway._backend_order = lambda: [broken, healthy]  # pin the order: always try the broken one first
+    try:
+        await timed_calls(gateway, 10, 1)
+    finally:
+        await gateway.aclose()
+    assert not broken.healthy, "backend returning 503s was never marked unhealthy"
+    return "10/10 requests failed over from the 503 backend, which was marked unhealthy"
+
+
+async def check_no_failover_on_400(urls):
+    rejecting, healthy = Backend("rejecting", urls["rejecting"]), Backend("healthy", urls["healthy"])
+    gateway = LLMGateway([rejecting, healthy], max_retries=3, backoff_base=0.5)
+    gateway._backend_order = lambda: [rejecting, healthy]
+    start = time.monotonic()
+    try:
+        await gateway.chat(MESSAGES, model="fake")
+    except RetryableLLMError as e:
+        raise AssertionError(f"400 was treated as retryable: {e}")
+    except LLMGatewayError:
+        elapsed = time.monotonic() - start
+        assert elapsed < 0.5, f"400 took {elapsed:.2f}s, so it was retried"
+        return "400 failed immediately without retry or failover"
+    finally:
+        await gateway.aclose()
+    raise AssertionError("400 response was failed over to the healthy backend")
+
+
+async def check_hedging(urls):
+    results = {}
+    for hedge in (False, True):
+        backend = Backend("tail", urls["tail"], max_concurrency=32)
+        gateway = LLMGateway([backend], hedge=hedge, hedge_min_samples=20)
+        try:
+            await timed_calls(gateway, 30, 8)  # warm up the latency window
+            results[hedge] = p99(await timed_calls(gateway, 300, 8))
+        finally:
+            await gateway.aclose()
+    assert results[True] < results[False] / 2, f"hedging did not cut p99: {results}"
+    return f"p99 {results[False]:.2f}s without hedging, {results[True]:.2f}s with"
+
+
+async def main():
+    configs = {
+        "healthy": {"FAKE_LATENCY": "0.01"},
+        "flaky": {"FAKE_LATENCY": "0.01", "FAKE_ERROR_RATE": "0.3"},
+        "broken": {"FAKE_LATENCY": "0.01", "FAKE_ERROR_RATE": "1", "FAKE_ERROR_STATUS": "503"},
+        "rejecting": {"FAKE_LATENCY": "0.01", "FAKE_ERROR_RATE": "1", "FAKE_ERROR_STATUS": "400"},
+        "tail": {"FAKE_LATENCY": "0.05", "FAKE_SLOW_RATE": "0.03", "FAKE_SLOW_LATENCY": "2"},
+    }
+    checks = [check_retry, check_failover, check_no_failover_on_400, check_hedging]
+    failed = 0
+    with fake_servers(configs) as urls:
+        for check in checks:
+            try:
+                print(f"PASS {check.__name__}: {await check(urls)}")
+            except Exception as e:
+                failed += 1
+                print(f"FAIL {check.__name__}: {e!r}")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,243 @@
+"""Per-stage timing, Server-Timing headers and on-demand profiling for the services.
+
+All four services import this single copy: their images are built from the
+repository root and copy `common/diagnostics.py` next to their `main.py`.
+
+- `stage(name)` opens an OpenTelemetry child span and records the stage's
+  duration for the current request.
+- `ServerTimingMiddleware` returns those durations in a `Server-Timing`
+  header, together with the timings reported by downstream services
+  (added with `record_downstream_timing`) under a per-hop prefix.
+- `install_debug_routes(app)` adds `/debug/profile/cpu` and
+  `/debug/profile/memory`. Both capture for N seconds and return
+  collapsed stacks (`frame;frame;frame weight` per line), which
+  flamegraph.pl, speedscope and inferno read directly. The CPU profile
+  drops threads that are parked in a known wait (event loop `select`,
+  `Condition.wait`, idle executor workers); with `idle=true` they are kept
+  and the output becomes a wall-clock profile. The routes only answer when
+  `DEBUG_TOKEN` is set and the request sends it in `X-Debug-Token`.
+"""
+import asyncio
+import contextvars
+import hmac
+import os
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from contextlib import contextmanager
+from typing import Dict, Optional
+
+try:
+    from opentelemetry import trace
+except ImportError:  # the embedding service runs without OpenTelemetry
+    trace = None
+
+DEBUG_TOKEN = os.getenv("DEBUG_TOKEN")
+MAX_PROFILE_SECONDS = float(os.getenv("MAX_PROFILE_SECONDS", 60))
+
+# One capture of each kind at a time: overlapping tracemalloc windows stop each other.
+_cpu_profile_lock = threading.Lock()
+_memory_profile_lock = threading.Lock()
+
+# Innermost frames of a thread that is waiting rather than running, as (function, file).
+# The event loop blocks in selectors' select() for every selector kind, queue.get and
+# Event.wait end in Condition.wait, and an idle executor worker blocks in the C
+# SimpleQueue.get directly from _worker.
+_IDLE_FRAMES = {
+    ("select", "selectors.py"),
+    ("wait", "threading.py"),
+    ("_wait_for_tstate_lock", "threading.py"),
+    ("_worker", "thread.py"),
+}
+
+_timings: contextvars.ContextVar[Optional[Dict[str, float]]] = contextvars.ContextVar("server_timings", default=None)
+
+
+def _record(name: str, millis: float):
+    timings = _timings.get()
+    if timings is not None:
+        timings[name] = timings.get(name, 0.0) + millis
+
+
+@contextmanager
+def stage(name: str):
+    """Times a request stage as a child span and a Server-Timing entry."""
+    span = trace.get_tracer("diagnostics").start_as_current_span(name) if trace else None
+    start = time.perf_counter()
+    try:
+        if span is None:
+            yield
+        else:
+            with span:
+                yield
+    finally:
+        _record(name, (time.perf_counter() - start) * 1000)
+
+
+def record_downstream_timing(prefix: str, headers):
+    """Folds a downstream response's Server-Timing header into this request's timings."""
+    value = headers.get("server-timing") if headers is not None else None
+    if not value:
+        return
+    for entry in value.split(","):
+        parts = [p.strip() for p in entry.split(";")]
+        dur = next((p[4:] for p in parts[1:] if p.startswith("dur=")), None)
+        if parts[0] and dur is not None:
+            try:
+                _record(f"{prefix}.{parts[0]}", float(dur))
+            except ValueError:
+                continue
+
+
+def format_server_timing(timings: Dict[str, float]) -> str:
+    return ", ".join(f"{name};dur={millis:.1f}" for name, millis in timings.items())
+
+
+class ServerTimingMiddleware:
+    """ASGI middleware that adds a Server-Timing header built from `stage` timings."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        timings: Dict[str, float] = {}
+        token = _timings.set(timings)
+        start = time.perf_counter()
+
+        async def send_with_timing(message):
+            if message["type"] == "http.response.start":
+                entries = dict(timings)
+                entries["total"] = (time.perf_counter() - start) * 1000
+                headers = list(message.get("headers", []))
+                headers.append((b"server-timing", format_server_timing(entries).encode("latin-1")))
+                message = {**message, "headers": headers}
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            _timings.reset(token)
+
+
+def _frame_name(frame) -> str:
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})"
+
+
+def _fold(frames) -> str:
+    return ";".join(_frame_name(f) for f in reversed(frames))
+
+
+def _is_idle(frame) -> bool:
+    return (frame.f_code.co_name, os.path.basename(frame.f_code.co_filename)) in _IDLE_FRAMES
+
+
+class _CpuSampler(threading.Thread):
+    """Samples every other thread's stack at a fixed interval.
+
+    Threads whose innermost frame is a known wait are skipped unless `idle`
+    is set, in which case every thread counts at every tick (wall-clock).
+    """
+
+    def __init__(self, interval: float, idle: bool = False):
+        super().__init__(daemon=True)
+        self.interval = interval
+        self.idle = idle
+        self.samples: Counter = Counter()
+        self._stop_event = threading.Event()
+
+    def run(self):
+        own = threading.get_ident()
+        while not self._stop_event.wait(self.interval):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own or (not self.idle and _is_idle(frame)):
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(frame)
+                    frame = frame.f_back
+                self.samples[_fold(stack)] += 1
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+
+
+def _collapsed(counter: Counter) -> str:
+    return "\n".join(f"{stack} {count}" for stack, count in counter.most_common()) + "\n"
+
+
+async def capture_cpu_profile(seconds: float, interval: float = 0.005, idle: bool = False) -> str:
+    sampler = _CpuSampler(interval, idle)
+    sampler.start()
+    try:
+        await asyncio.sleep(seconds)
+    finally:
+        sampler.stop()
+    return _collapsed(sampler.samples)
+
+
+async def capture_memory_profile(seconds: float) -> str:
+    """Bytes allocated and still live after `seconds`, by allocation stack."""
+    started_here = not tracemalloc.is_tracing()
+    if started_here:
+        tracemalloc.start(25)
+    baseline = tracemalloc.take_snapshot()
+    try:
+        await asyncio.sleep(seconds)
+        snapshot = tracemalloc.take_snapshot()
+    finally:
+        if started_here:
+            tracemalloc.stop()
+
+    counter: Counter = Counter()
+    for diff in snapshot.compare_to(baseline, "traceback"):
+        if diff.size_diff <= 0:
+            continue
+        stack = ";".join(f"{os.path.basename(f.filename)}:{f.lineno}" for f in diff.traceback)
+        counter[stack] += diff.size_diff
+    return _collapsed(counter)
+
+
+def install_debug_routes(app):
+    """Adds the token-protected profiling routes to a FastAPI app."""
+    from fastapi import Header, HTTPException
+    from fastapi.responses import PlainTextResponse
+
+    def authorize(token: Optional[str]):
+        if not DEBUG_TOKEN:
+            raise HTTPException(status_code=404, detail="Not Found")
+        if not token or not hmac.compare_digest(token, DEBUG_TOKEN):
+            raise HTTPException(status_code=401, detail="Invalid debug token")
+
+    async def exclusive(lock: threading.Lock, capture, *args):
+        if not lock.acquire(blocking=False):
+            raise HTTPException(status_code=409, detail="A profile capture is already running")
+        try:
+            return await capture(*args)
+        finally:
+            lock.release()
+
+    def attachment(body: str, filename: str):
+        return PlainTextResponse(body, headers={"Content-Disposition": f'attachment; filename="{filename}"'})
+
+    @app.get("/debug/profile/cpu", include_in_schema=False)
+    async def cpu_profile(seconds: float = 10, interval: float = 0.005, idle: bool = False,
+                          x_debug_token: Optional[str] = Header(None)):
+        authorize(x_debug_token)
+        seconds = min(max(seconds, 0.1), MAX_PROFILE_SECONDS)
+        body = await exclusive(_cpu_profile_lock, capture_cpu_profile, seconds, max(interval, 0.001), idle)
+        return attachment(body, "cpu.folded")
+
+    @app.get("/debug/profile/memory", include_in_schema=False)
+    async def memory_profile(seconds: float = 10, x_debug_token: Optional[str] = Header(None)):
+        authorize(x_debug_token)
+        seconds = min(max(seconds, 0.1), MAX_PROFILE_SECONDS)
+        body = await exclusive(_memory_profile_lock, capture_memory_profile, seconds)
+        return attachment(body, "memory.folded")
@@ -0,0 +1,77 @@
+"""Minimal OpenAI-compatible server for exercising `llm_gateway` locally.
+
+Latency and failures are configurable so retries, hedging and failover can be
+observed without a RunPod endpoint:
+
+    FAKE_LATENCY=0.3 FAKE_SLOW_RATE=0.1 FAKE_SLOW_LATENCY=5 FAKE_ERROR_RATE=0.1 \
+        uvicorn fake_openai_server:app --port 9000
+
+then point an agent at it with
+`LLM_BACKENDS='[{"name": "fake", "base_url": "http://localhost:9000/v1"}]'`.
+"""
+import asyncio
+import json
+import os
+import random
+import time
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+import uvicorn
+
+app = FastAPI()
+
+LATENCY = float(os.getenv("FAKE_LATENCY", 0.2))
+SLOW_RATE = float(os.getenv("FAKE_SLOW_RATE", 0.0))
+SLOW_LATENCY = float(os.getenv("FAKE_SLOW_LATENCY", 5.0))
+ERROR_RATE = float(os.getenv("FAKE_ERROR_RATE", 0.0))
+ERROR_STATUS = int(os.getenv("FAKE_ERROR_STATUS", 503))
+TOKEN_LATENCY = float(os.getenv("FAKE_TOKEN_LATENCY", 0.02))
+REPLY = os.getenv("FAKE_REPLY", "<think> Ngữ cảnh đủ để trả lời. </think> <answer> USE_RAG </answer>")
+
+
+@app.post("/v1/chat/completions")
+async def chat_completions(request: Request):
+    body = await request.json()
+    slow = random.random() < SLOW_RATE
+    await asyncio.sleep(SLOW_LATENCY if slow else LATENCY)
+
+    if random.random() < ERROR_RATE:
+        return JSONResponse(status_code=ERROR_STATUS, content={"error": {"message": "injected failure"}})
+
+    if body.get("stream"):
+        return StreamingResponse(stream_reply(body), media_type="text/event-stream")
+
+    return {
+        "id": f"chatcmpl-fake-{time.time_ns()}",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": body.get("model", "fake"),
+        "choices": [{
+            "index": 0,
+            "message": {"role": "assistant", "content": REPLY},
+            "finish_reason": "stop",
+        }],
+        "usage": {"prompt_tokens": 0, "completion_tokens": len(REPLY.split()), "total_tokens": len(REPLY.split())},
+    }
+
+
+async def stream_reply(body: dict):
+    """Streams REPLY word by word as OpenAI-style SSE chunks, honouring `stop`."""
+    text = REPLY
+    for stop in body.get("stop") or []:
+        if stop in text:
+            text = text[:text.index(stop)]
+    for i, word in enumerate(text.split(" ")):
+        await asyncio.sleep(TOKEN_LATENCY)
+        chunk = {
+            "object": "chat.completion.chunk",
+            "model": body.get("model", "fake"),
+            "choices": [{"index": 0, "delta": {"content": word if i == 0 else " " + word}, "finish_reason": None}],
+        }
+        yield f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n"
+    yield "data: [DONE]\n\n"
+
+
+if __name__ == "__main__":
+    uvicorn.run(app, host="0.0.0.0", port=9000)
@@ -0,0 +1,71 @@
+"""Per-call-site generation profiles and streaming completion checks.
+
+Each LLM call site declares a `GenerationProfile`: its token budget,
+sampling parameters, server-side stop sequences and, optionally, a
+`stop_when` check. When `stop_when` is set, `LLMGateway.chat` streams the
+completion and closes the stream as soon as the check reports that the
+structure the caller needs is complete. Closing the stream also makes the
+server abort the generation.
+"""
+import re
+from dataclasses import dataclass, field
+from typing import Callable, List, Optional, Tuple
+
+USE_RAG = "USE_RAG"
+ANSWER_PREFIX = "ANSWER:"
+
+_REFINED_QUERY_LINE = re.compile(r"Refined Query:\s*\S[^\n]*\n", re.IGNORECASE)
+_ANSWER_TAGS = re.compile(r"</?answer>", re.IGNORECASE)
+
+
+@dataclass(frozen=True)
+class GenerationProfile:
+    name: str
+    model: str
+    max_tokens: int
+    temperature: float = 0.6
+    top_p: float = 0.8
+    stop: List[str] = field(default_factory=list)
+    stop_when: Optional[Callable[[str], bool]] = None
+
+    def params(self) -> dict:
+        """Request parameters for `LLMGateway.chat`."""
+        params = {
+            "model": self.model,
+            "max_tokens": self.max_tokens,
+            "temperature": self.temperature,
+            "top_p": self.top_p,
+            "stop_when": self.stop_when,
+        }
+        if self.stop:
+            params["stop"] = list(self.stop)
+        return params
+
+
+def classifier_complete(text: str) -> bool:
+    """The classifier is done as soon as it has committed to `USE_RAG`."""
+    return text.lstrip().lstrip('"').startswith(USE_RAG)
+
+
+def parse_classifier_output(text: str) -> Tuple[bool, str]:
+    """Returns `(use_rag, direct_answer)` from constrained classifier output."""
+    text = text.strip()
+    if USE_RAG in text:
+        return True, ""
+    if text.upper().startswith(ANSWER_PREFIX):
+        text = text[len(ANSWER_PREFIX):].strip()
+    return False, text
+
+
+def rag_answer_complete(text: str) -> bool:
+    """The RAG answer is done once `</answer>` or a full `Refined Query:` line follows `</think>`."""
+    parts = text.split("</think>", 1)
+    if len(parts) < 2:
+        return False
+    answer = parts[1]
+    return "</answer>" in answer.lower() or bool(_REFINED_QUERY_LINE.search(answer))
+
+
+def strip_answer_tags(text: str) -> str:
+    """Removes `<answer>` tags, including an unterminated one left by a stop sequence."""
+    return _ANSWER_TAGS.sub("", text).strip()
@@ -0,0 +1,371 @@
+"""Shared LLM client layer for the primary agent and the RAG reasoning agent.
+
+Talks to any OpenAI-compatible `/chat/completions` endpoint (RunPod serverless,
+vLLM, or the local fake server in `fake_openai_server.py`) and adds:
+- per-backend concurrency caps plus a token-bucket request rate limit
+- jittered exponential backoff on retryable errors (timeouts, 429, 5xx)
+- an optional hedged second request once the p95 latency has elapsed,
+  cancelling whichever request loses the race
+- weighted failover across several backends
+- a capped lane for batch traffic so bulk jobs leave room for interactive requests
+- optional streaming that stops reading once the caller has what it needs
+  (see `generation.GenerationProfile.stop_when`)
+"""
+import asyncio
+import json
+import logging
+import os
+import random
+import time
+from collections import deque
+from typing import Callable, Dict, List, Optional
+
+import httpx
+
+logger = logging.getLogger(__name__)
+
+RETRYABLE_STATUS_CODES = {408, 409, 425, 429, 500, 502, 503, 504}
+
+StopCheck = Callable[[str], bool]
+
+
+class LLMGatewayError(Exception):
+    """Raised when no backend could produce a completion."""
+
+
+class RetryableLLMError(LLMGatewayError):
+    """A failure that is worth retrying (timeouts, throttling, 5xx)."""
+
+
+class TokenBucket:
+    """Async token bucket: `rate` requests per second with bursts up to `capacity`."""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._lock = None
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def try_acquire(self) -> bool:
+        if self.rate <= 0:
+            return True
+        self._refill()
+        if self._tokens >= 1:
+            self._tokens -= 1
+            return True
+        return False
+
+    async def acquire(self):
+        if self.rate <= 0:
+            return
+        # Created lazily so it binds to the serving event loop, not the import-time one.
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            while not self.try_acquire():
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+class LatencyTracker:
+    """Rolling window of successful request latencies, used to pick the hedge delay."""
+
+    def __init__(self, window: int = 200):
+        self._samples = deque(maxlen=window)
+
+    def record(self, seconds: float):
+        self._samples.append(seconds)
+
+    def __len__(self):
+        return len(self._samples)
+
+    def percentile(self, q: float) -> Optional[float]:
+        if not self._samples:
+            return None
+        ordered = sorted(self._samples)
+        index = min(len(ordered) - 1, int(round(q * (len(ordered) - 1))))
+        return ordered[index]
+
+
+class Backend:
+    """One OpenAI-compatible endpoint with its own limits and health state."""
+
+    def __init__(
+        self,
+        name: str,
+        base_url: str,
+        api_key: Optional[str] = None,
+        model: Optional[str] = None,
+        weight: float = 1.0,
+        max_concurrency: int = 8,
+        batch_max_concurrency: Optional[int] = None,
+        rate_per_sec: float = 0.0,
+        burst: Optional[float] = None,
+    ):
+        self.name = name
+        self.base_url = base_url.rstrip("/")
+        self.api_key = api_key
+        self.model = model
+        self.weight = weight
+        self.max_concurrency = max_concurrency
+        self.batch_max_concurrency = batch_max_concurrency or max(1, max_concurrency // 2)
+        self._semaphore = None
+        self._batch_semaphore = None
+        self.bucket = TokenBucket(rate_per_sec, burst if burst is not None else max(1.0, rate_per_sec))
+        self.latency = LatencyTracker()
+        self.consecutive_failures = 0
+        self.unhealthy_until = 0.0
+
+    @property
+    def semaphore(self) -> asyncio.Semaphore:
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        return self._semaphore
+
+    @property
+    def batch_semaphore(self) -> asyncio.Semaphore:
+        if self._batch_semaphore is None:
+            self._batch_semaphore = asyncio.Semaphore(self.batch_max_concurrency)
+        return self._batch_semaphore
+
+    @property
+    def healthy(self) -> bool:
+        return time.monotonic() >= self.unhealthy_until
+
+    def headers(self) -> Dict[str, str]:
+        return {"Authorization": f"Bearer {self.api_key}"} if self.api_key else {}
+
+
+class LLMGateway:
+    """Routes chat completions across backends with retries, hedging and failover."""
+
+    def __init__(
+        self,
+        backends: List[Backend],
+        max_retries: int = 2,
+        backoff_base: float = 0.5,
+        backoff_cap: float = 8.0,
+        timeout: float = 120.0,
+        hedge: bool = False,
+        hedge_percentile: float = 0.95,
+        hedge_min_samples: int = 20,
+        failure_threshold: int = 3,
+        cooldown: float = 30.0,
+    ):
+        if not backends:
+            raise ValueError("LLMGateway needs at least one backend")
+        self.backends = backends
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_cap = backoff_cap
+        self.timeout = timeout
+        self.hedge = hedge
+        self.hedge_percentile = hedge_percentile
+        self.hedge_min_samples = hedge_min_samples
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self._client = httpx.AsyncClient(timeout=timeout)
+
+    async def aclose(self):
+        await self._client.aclose()
+
+    def _backend_order(self) -> List[Backend]:
+        """Weighted random order without replacement; unhealthy backends go last."""
+        keyed = [(random.random() ** (1.0 / max(b.weight, 1e-6)), b) for b in self.backends]
+        keyed.sort(key=lambda item: item[0], reverse=True)
+        ordered = [b for _, b in keyed]
+        return [b for b in ordered if b.healthy] + [b for b in ordered if not b.healthy]
+
+    def _hedge_delay(self, backend: Backend) -> Optional[float]:
+        if not self.hedge or len(backend.latency) < self.hedge_min_samples:
+            return None
+        return backend.latency.percentile(self.hedge_percentile)
+
+    def _backoff(self, attempt: int) -> float:
+        """Full-jitter exponential backoff."""
+        return random.uniform(0, min(self.backoff_cap, self.backoff_base * (2 ** attempt)))
+
+    def _mark(self, backend: Backend, ok: bool):
+        if ok:
+            backend.consecutive_failures = 0
+            return
+        backend.consecutive_failures += 1
+        if backend.consecutive_failures >= self.failure_threshold:
+            backend.unhealthy_until = time.monotonic() + self.cooldown
+            logger.warning(f"LLM backend '{backend.name}' marked unhealthy for {self.cooldown}s")
+
+    async def _request(self, backend: Backend, payload: dict, stop_when: Optional[StopCheck],
+                       batch: bool = False) -> str:
+        if batch:
+            # Batch calls must hold a batch slot first, so they can never take every slot.
+            async with backend.batch_semaphore:
+                return await self._request(backend, payload, stop_when)
+        async with backend.semaphore:
+            await backend.bucket.acquire()
+            return await self._send(backend, payload, stop_when)
+
+    @staticmethod
+    def _check_status(backend: Backend, response: httpx.Response, body: str):
+        if response.status_code in RETRYABLE_STATUS_CODES:
+            raise RetryableLLMError(f"{backend.name}: HTTP {response.status_code}")
+        if response.status_code >= 400:
+            raise LLMGatewayError(f"{backend.name}: HTTP {response.status_code} {body[:200]}")
+
+    async def _send(self, backend: Backend, payload: dict, stop_when: Optional[StopCheck]) -> str:
+        body = dict(payload)
+        if backend.model:
+            body["model"] = backend.model
+        url = f"{backend.base_url}/chat/completions"
+        start = time.monotonic()
+        try:
+            if stop_when is None:
+                response = await self._client.post(url, json=body, headers=backend.headers())
+                self._check_status(backend, response, response.text)
+                result = response.json()["choices"][0]["message"]["content"]
+            else:
+                result = await self._stream(backend, url, body, stop_when)
+        except (httpx.TimeoutException, httpx.TransportError) as e:
+            raise RetryableLLMError(f"{backend.name}: {e!r}") from e
+
+        backend.latency.record(time.monotonic() - start)
+        return result
+
+    async def _stream(self, backend: Backend, url: str, body: dict, stop_when: StopCheck) -> str:
+        """Streams the completion and hangs up as soon as `stop_when` accepts the text so far."""
+        body["stream"] = True
+        text = ""
+        chunks = 0
+        async with self._client.stream("POST", url, json=body, headers=backend.headers()) as response:
+            if response.status_code >= 400:
+                await response.aread()
+                self._check_status(backend, response, response.text)
+            async for line in response.aiter_lines():
+                if not line.startswith("data:"):
+                    continue
+                data = line[len("data:"):].strip()
+                if data == "[DONE]":
+                    break
+                choices = json.loads(data).get("choices") or []
+                delta = choices[0].get("delta", {}).get("content") if choices else None
+                if not delta:
+                    continue
+                text += delta
+                chunks += 1
+                if stop_when(text):
+                    logger.info(f"Stopped LLM stream early after {chunks} chunks")
+                    break
+        return text
+
+    async def _hedged(self, backend: Backend, hedge_backend: Backend, payload: dict,
+                      stop_when: Optional[StopCheck] = None, batch: bool = False) -> str:
+        """Send to `backend`; if it is slower than its p95, race a second copy and keep the winner."""
+        primary = asyncio.ensure_future(self._request(backend, payload, stop_when, batch))
+        pending = {primary}
+        try:
+            # Batch traffic is not latency sensitive, so it never spends capacity on hedges.
+            delay = None if batch else self._hedge_delay(backend)
+            if delay is None:
+                return await primary
+
+            done, _ = await asyncio.wait(pending, timeout=delay)
+            if done:
+                return primary.result()
+
+            # Only hedge into spare capacity so hedging never queues behind real traffic.
+            if hedge_backend.semaphore.locked() or not hedge_backend.bucket.try_acquire():
+                return await primary
+
+            logger.info(f"Hedging LLM request to '{hedge_backend.name}' after {delay:.2f}s")
+
+            async def hedge_request():
+                async with hedge_backend.semaphore:
+                    return await self._send(hedge_backend, payload, stop_when)
+
+            pending.add(asyncio.ensure_future(hedge_request()))
+            last_error = None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        return task.result()
+                    last_error = task.exception()
+            raise last_error
+        finally:
+            for task in pending:
+                task.cancel()
+
+    async def chat(self, messages: List[dict], model: str,
+                   stop_when: Optional[StopCheck] = None, batch: bool = False, **params) -> str:
+        """Returns the assistant message content for an OpenAI-style chat request.
+
+        With `stop_when`, the completion is streamed and cut off once
+        `stop_when(text_so_far)` returns True. `batch=True` routes the call
+        through the backend's capped batch lane.
+        """
+        payload = {"model": model, "messages": messages, **params}
+        order = self._backend_order()
+        last_error = None
+
+        for index, backend in enumerate(order):
+            hedge_backend = order[(index + 1) % len(order)]
+            for attempt in range(self.max_retries + 1):
+                try:
+                    result = await self._hedged(backend, hedge_backend, payload, stop_when, batch)
+                    self._mark(backend, ok=True)
+                    return result
+                except RetryableLLMError as e:
+                    last_error = e
+                    self._mark(backend, ok=False)
+                    if attempt < self.max_retries and backend.healthy:
+                        delay = self._backoff(attempt)
+                        logger.warning(f"Retryable LLM error ({e}); retrying in {delay:.2f}s")
+                        await asyncio.sleep(delay)
+                    else:
+                        break
+            logger.warning(f"LLM backend '{backend.name}' exhausted, failing over")
+
+        raise LLMGatewayError(f"All LLM backends failed: {last_error}")
+
+
+def gateway_from_env() -> LLMGateway:
+    """Builds a gateway from environment variables.
+
+    `LLM_BACKENDS` may hold a JSON list of backend objects (`name`, `base_url`,
+    `api_key`, `model`, `weight`, `max_concurrency`, `batch_max_concurrency`,
+    `rate_per_sec`, `burst`).
+    Without it a single RunPod backend is built from `RUNPOD_ENDPOINT_ID` and
+    `RUNPOD_API_KEY`, as before.
+    """
+    default_key = os.getenv("RUNPOD_API_KEY")
+    raw_backends = os.getenv("LLM_BACKENDS")
+    if raw_backends:
+        configs = json.loads(raw_backends)
+    else:
+        configs = [{
+            "name": "runpod",
+            "base_url": f"https://api.runpod.ai/v2/{os.getenv('RUNPOD_ENDPOINT_ID')}/openai/v1",
+        }]
+
+    backends = []
+    for i, config in enumerate(configs):
+        config = dict(config)
+        config.setdefault("name", f"backend-{i}")
+        config.setdefault("api_key", default_key)
+        config.setdefault("max_concurrency", int(os.getenv("LLM_MAX_CONCURRENCY", 8)))
+        if os.getenv("LLM_BATCH_MAX_CONCURRENCY"):
+            config.setdefault("batch_max_concurrency", int(os.getenv("LLM_BATCH_MAX_CONCURRENCY")))
+        config.setdefault("rate_per_sec", float(os.getenv("LLM_RATE_PER_SEC", 0)))
+        backends.append(Backend(**config))
+
+    return LLMGateway(
+        backends,
+        max_retries=int(os.getenv("LLM_MAX_RETRIES", 2)),
+        timeout=float(os.getenv("LLM_TIMEOUT", 120)),
+        hedge=os.getenv("LLM_HEDGE", "false").lower() in ("1", "true", "yes"),
+        hedge_percentile=float(os.getenv("LLM_HEDGE_PERCENTILE", 0.95)),
+    )
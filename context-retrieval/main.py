@@ -1,4 +1,4 @@
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Header
 from pydantic import BaseModel
 import weaviate
 import httpx
@@ -6,6 +6,13 @@ from pyvi.ViTokenizer import tokenize
 import uvicorn
 import asyncio
 import os
+import re
+import contextvars
+import logging
+import time
+from typing import Optional
+
+from diagnostics import ServerTimingMiddleware, install_debug_routes, record_downstream_timing, stage
 
 from opentelemetry import trace
 from opentelemetry.sdk.trace import TracerProvider
@@ -30,42 +37,120 @@ trace.set_tracer_provider(trace_provider)
 app = FastAPI()
 HTTPXClientInstrumentor().instrument() 
 FastAPIInstrumentor.instrument_app(app, tracer_provider=trace_provider)
+app.add_middleware(ServerTimingMiddleware)
+install_debug_routes(app)
+
+logger = logging.getLogger(__name__)
 
 
 WEAVIATE_URL = os.getenv("WEAVIATE_URL", "http://weaviate.weaviate.svc.cluster.local:85")
 VECTORIZE_URL = os.getenv("VECTORIZE_URL", "http://emb-svc.emb.svc.cluster.local:65001/vectorize")
+VECTORIZE_BATCH_URL = os.getenv("VECTORIZE_BATCH_URL", f"{VECTORIZE_URL}-batch")
+EMBED_BATCHING = os.getenv("EMBED_BATCHING", "true").lower() in ("1", "true", "yes")
+EMBED_MAX_BATCH = int(os.getenv("EMBED_MAX_BATCH", 32))
+EMBED_BATCH_RETRY_AFTER = float(os.getenv("EMBED_BATCH_RETRY_AFTER", 60))
 
 class QueryRequest(BaseModel):
     query: str
     limit: int = 5
     alpha: float = 0.5
+    collection: str = "Document"  # Weaviate class; the retrieval eval harness points this at candidate indexes
 
 async def fetch_vectorized_query(tokenized_query: str):
     """Sends the tokenized query to the embedding service and retrieves vector representation."""
     async with httpx.AsyncClient() as client:
         response = await client.post(VECTORIZE_URL, json={"text": tokenized_query})
         response.raise_for_status()
+        record_downstream_timing("emb", response.headers)
         return response.json().get("vector")
 
+class EmbeddingBatcher:
+    """Coalesces concurrent batch-priority embedding requests into /vectorize-batch calls.
+
+    A batch is sent as soon as the previous one returns, so a lone request is
+    never delayed, while requests arriving during an in-flight call share the
+    next one. Each waiter gets the batch call's Server-Timing header with its
+    vector and records it in its own request context.
+
+    If the batch call fails, each waiter falls back to /vectorize on its own.
+    A 404 means the embedding service predates /vectorize-batch, so batching
+    is skipped for `retry_after` seconds before it is tried again.
+    """
+
+    def __init__(self, url: str, max_batch: int, retry_after: float):
+        self.url = url
+        self.max_batch = max_batch
+        self.retry_after = retry_after
+        self._queue = []
+        self._worker = None
+        self._unsupported_until = 0.0
+
+    async def embed(self, text: str):
+        if time.monotonic() < self._unsupported_until:
+            return await fetch_vectorized_query(text)
+        future = asyncio.get_running_loop().create_future()
+        self._queue.append((text, future))
+        if self._worker is None or self._worker.done():
+            # Run the worker outside this caller's context so its spans and timings aren't attributed to one request
+            self._worker = contextvars.Context().run(asyncio.ensure_future, self._drain())
+        try:
+            vector, server_timing = await future
+        except Exception as e:
+            logger.warning(f"Batch embedding failed, falling back to {VECTORIZE_URL}: {e}")
+            return await fetch_vectorized_query(text)
+        record_downstream_timing("emb", {"server-timing": server_timing})
+        return vector
+
+    async def _drain(self):
+        while self._queue:
+            batch, self._queue = self._queue[:self.max_batch], self._queue[self.max_batch:]
+            texts = list(dict.fromkeys(text for text, _ in batch))
+            try:
+                async with httpx.AsyncClient() as client:
+                    response = await client.post(self.url, json={"texts": texts})
+                    if response.status_code == 404:
+                        self._unsupported_until = time.monotonic() + self.retry_after
+                    response.raise_for_status()
+                vectors = dict(zip(texts, response.json()["vectors"]))
+                server_timing = response.headers.get("server-timing")
+                for text, future in batch:
+                    if not future.done():
+                        future.set_result((vectors[text], server_timing))
+            except Exception as e:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+
+embedding_batcher = EmbeddingBatcher(VECTORIZE_BATCH_URL, EMBED_MAX_BATCH, EMBED_BATCH_RETRY_AFTER)
+
 @app.post("/retrieve-context")
-async def retrieve_context(request: QueryRequest):
+async def retrieve_context(request: QueryRequest, x_request_priority: Optional[str] = Header(None)):
+        if not re.fullmatch(r"[A-Z][A-Za-z0-9_]*", request.collection):
+            raise HTTPException(status_code=400, detail="Invalid collection name")
         client_weaviate = weaviate.Client(url=WEAVIATE_URL)
-        tokenized_query = tokenize(request.query)
+        with stage("tokenize"):
+            tokenized_query = tokenize(request.query)
 
-        # Fetch vector embedding asynchronously
-        query_vector = await fetch_vectorized_query(tokenized_query)
+        # Fetch vector embedding asynchronously; only batch traffic is coalesced, interactive queries go straight to /vectorize
+        with stage("embedding"):
+            if EMBED_BATCHING and x_request_priority == "batch":
+                query_vector = await embedding_batcher.embed(tokenized_query)
+            else:
+                query_vector = await fetch_vectorized_query(tokenized_query)
 
         # Query Weaviate database
-        res = await asyncio.to_thread(
-            lambda: client_weaviate.query.get("Document", ["content"])
-                .with_hybrid(query=request.query, alpha=request.alpha, vector=query_vector)
-                .with_limit(request.limit)
-                .do()
-        )
+        with stage("weaviate"):
+            res = await asyncio.to_thread(
+                lambda: client_weaviate.query.get(request.collection, ["content"])
+                    .with_hybrid(query=request.query, alpha=request.alpha, vector=query_vector)
+                    .with_limit(request.limit)
+                    .do()
+            )
 
         # Format the retrieved context
-        contents = [doc["content"] for doc in res["data"]["Get"]["Document"]]
-        context_string = "\n------------------------------------------------------------\n".join(contents)
+        with stage("format_context"):
+            contents = [doc["content"] for doc in res["data"]["Get"][request.collection]]
+            context_string = "\n------------------------------------------------------------\n".join(contents)
 
 
         return {"context": context_string}
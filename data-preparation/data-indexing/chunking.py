@@ -0,0 +1,168 @@
+"""PDF text extraction and chunking used to build the Weaviate index.
+
+Same steps as the first cell of `notebook.ipynb`, with the chunk size and
+overlap exposed so `evaluate_retrieval.py` can build candidate indexes.
+"""
+import json
+import re
+from PyPDF2 import PdfReader
+import fitz  # PyMuPDF
+from langchain.text_splitter import RecursiveCharacterTextSplitter
+
+def extract_text_with_pypdf2(pdf_path):
+    """Extract text from a PDF file using PyPDF2."""
+    text = ""
+    reader = PdfReader(pdf_path)
+    for page in reader.pages:
+        text += page.extract_text()
+    return text
+
+def extract_text_with_fitz(pdf_path):
+    """Extract text from a PDF file using fitz (PyMuPDF)."""
+    text = ""
+    doc = fitz.open(pdf_path)
+    for page_num in range(len(doc)):  # Start from 0 to include all pages
+        page = doc.load_page(page_num)
+        text += page.get_text("text")
+    return text
+
+def preprocess_and_chunk_text(text):
+    """
+    Preprocess the text and split it into chunks with titles and contexts.
+    - Titles include both the current chapter and article.
+    - Contexts contain the text under each article.
+    """
+    # Define regex patterns for identifying chapters and articles
+    chapter_pattern = r"(Chương\s+[IVXLCDM]+\s*[\n\r]*[A-ZÀÁẢÃẠĂẮẰẲẴẶÂẤẦẨẪẬĐÈÉẺẼẸÊẾỀỂỄỆÌÍỈĨỊÒÓỎÕỌÔỐỒỔỖỘƠỚỜỞỠỢÙÚỦŨỤƯỨỪỬỮỰ\s]+?)(?=\s*Điều|$)"
+    article_pattern = r"(Điều\s+\d+[a-z]?\.\s*[A-ZÀÁẢÃẠĂẮẰẲẴẶÂẤẦẨẪẬĐÈÉẺẼẸÊẾỀỂỄỆÌÍỈĨỊÒÓỎÕỌÔỐỒỔỖỘƠỚỜỞỠỢÙÚỦŨỤƯỨỪỬỮỰ][^\n]+)"
+    
+    # Split the text into sections based on chapters and articles
+    sections = re.split(f"({chapter_pattern}|{article_pattern})", text, flags=re.DOTALL)
+    
+    # Initialize variables for processing
+    current_chapter = None
+    current_article = None
+    chunks = []
+    buffer = ""
+    
+    for section in sections:
+        # Skip None or empty sections
+        if section is None or not section.strip():
+            continue
+        
+        # Check if the section is a chapter title
+        chapter_match = re.match(chapter_pattern, section)
+        if chapter_match:
+            # If there's a previous article, save its content as a chunk
+            if current_article and buffer.strip():
+                chunk = {
+                    "title": f"{current_article} {current_chapter}",
+                    "context": buffer.strip()
+                }
+                chunks.append(chunk)
+            
+            # Update the current chapter
+            current_chapter = section.strip()
+            current_article = None  # Reset article when a new chapter starts
+            buffer = ""  # Reset buffer for new chapter
+            continue
+        
+        # Check if the section is an article title
+        article_match = re.match(article_pattern, section)
+        if article_match:
+            # If there's a previous article, save its content as a chunk
+            if current_article and buffer.strip():
+                chunk = {
+                    "title": f"{current_article} {current_chapter}",
+                    "context": buffer.strip()
+                }
+                chunks.append(chunk)
+            
+            # Update the current article
+            current_article = section.strip()
+            buffer = ""  # Reset buffer for new article
+            continue
+        
+        # If it's neither a chapter nor an article, it's part of the current article's content
+        if current_article:
+            buffer += " " + section.strip()
+    
+    # Add the last chunk if there's any remaining content
+    if current_article and buffer.strip():
+        chunk = {
+            "title": f"{current_article} {current_chapter}",
+            "context": buffer.strip()
+        }
+        chunks.append(chunk)
+    
+    return chunks
+
+def split_long_context(title, context, max_length=800, chunk_overlap=300):
+    """
+    Split long context into smaller chunks using RecursiveCharacterTextSplitter.
+    Each smaller chunk retains the same title.
+    """
+    splitter = RecursiveCharacterTextSplitter(
+        chunk_size=max_length,
+        chunk_overlap=chunk_overlap,  # Overlap to ensure continuity between chunks
+        separators=["\n\n", "\n", ". ", " ", ""]
+    )
+    sub_chunks = splitter.split_text(context)
+    return [{"title": title, "context": sub_chunk.strip()} for sub_chunk in sub_chunks]
+
+def extract_text(pdf_path, extraction_method="pypdf2"):
+    """Extract raw text from the PDF with the chosen method."""
+    if extraction_method == "pypdf2":
+        return extract_text_with_pypdf2(pdf_path)
+    elif extraction_method == "fitz":
+        return extract_text_with_fitz(pdf_path)
+    else:
+        raise ValueError("Unsupported extraction method. Choose 'pypdf2' or 'fitz'.")
+
+def build_chunks(raw_text, max_length=800, chunk_overlap=300):
+    """Split the text into article chunks, then split articles longer than max_length."""
+    final_chunks = []
+    for chunk in preprocess_and_chunk_text(raw_text):
+        title = chunk["title"]
+        context = chunk["context"]
+        if len(context) > max_length:  # If context is too long, split it
+            final_chunks.extend(split_long_context(title, context, max_length, chunk_overlap))
+        else:
+            final_chunks.append(chunk)
+    return final_chunks
+
+def to_documents(chunks):
+    """Format chunks into the document strings stored in Weaviate."""
+    return [f"Trích dẫn ở: {item['title']} \n Nội dung như sau: {item['context']}" for item in chunks]
+
+def process_pdf(pdf_path, output_json, extraction_method="pypdf2", max_length=800, chunk_overlap=300):
+    """Process the PDF and save the output as JSON."""
+    # Step 1: Extract text from the PDF using the specified method
+    raw_text = extract_text(pdf_path, extraction_method)
+    
+    # Debug: Print first 500 characters of extracted text
+    print(f"Extracted text (first 500 chars): {raw_text[:500]}")
+    
+    # Step 2 and 3: Preprocess, chunk, and split long contexts
+    final_chunks = build_chunks(raw_text, max_length, chunk_overlap)
+    
+    # Debug: Print number of chunks created
+    print(f"Number of chunks created: {len(final_chunks)}")
+    
+    # Step 4: Save the chunks to a JSON file
+    save_to_json(final_chunks, output_json)
+
+def save_to_json(data, output_file):
+    """Save the processed data to a JSON file."""
+    with open(output_file, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False, indent=4)
+
+# Example usage
+if __name__ == "__main__":
+    pdf_path = "../data-indexing/RAG_data.pdf"
+    output_json = "output.json"
+    
+    # Choose the extraction method: "pypdf2" or "fitz"
+    extraction_method = "fitz"  # Change to "pypdf2" if needed
+    
+    process_pdf(pdf_path, output_json, extraction_method)
\ No newline at end of file
@@ -0,0 +1,211 @@
+"""Retrieval quality vs. cost for chunking, alpha and limit settings.
+
+For every (chunk size, overlap) pair this script chunks the PDF with
+`chunking.build_chunks`, embeds the chunks the same way as `notebook.ipynb`,
+and loads them into their own Weaviate class (`Eval_<size>_<overlap>`). It
+then sends each labelled question through the running context-retrieval
+service (`/retrieve-context` with `collection` set to that class) for every
+alpha and limit k, so every k is timed at its own limit. For each k it
+reports the following:
+- recall@k and MRR@k
+- index size
+- retrieval latency, both end to end and the Weaviate stage from Server-Timing
+- context tokens, counted with the RAG model's tokenizer
+
+Questions are JSONL: `{"question": "...", "articles": ["Điều 59", ...]}`. A
+retrieved chunk counts as relevant when its citation (`Trích dẫn ở: Điều N.`)
+names one of the listed articles, so the labels stay valid whatever the chunk
+size.
+
+Example, with Weaviate on 8085 and context-retrieval on 8005:
+
+    python evaluate_retrieval.py --questions eval_questions.jsonl \\
+        --chunk-sizes 400,600,800 --overlaps 0,100,300 --alphas 0.25,0.5,0.75 --ks 3,5,8
+"""
+import argparse
+import json
+import re
+import statistics
+import time
+
+import requests
+import weaviate
+from pyvi.ViTokenizer import tokenize
+from sentence_transformers import SentenceTransformer
+from transformers import AutoTokenizer
+
+from chunking import build_chunks, extract_text, to_documents
+
+CONTEXT_SEPARATOR = "\n------------------------------------------------------------\n"
+CITATION_PATTERN = re.compile(r"Trích dẫn ở:\s*(Điều\s+\d+[a-z]?)\.")
+
+
+def parse_list(value, cast):
+    return [cast(v) for v in value.split(",") if v.strip()]
+
+
+def normalize_article(article):
+    return " ".join(article.split())
+
+
+def load_questions(path):
+    with open(path, encoding="utf-8") as f:
+        questions = [json.loads(line) for line in f if line.strip()]
+    for q in questions:
+        q["articles"] = {normalize_article(a) for a in q["articles"]}
+    return questions
+
+
+def build_index(client, model, class_name, documents):
+    """(Re)creates `class_name` and imports the documents with their vectors."""
+    if client.schema.exists(class_name):
+        client.schema.delete_class(class_name)
+    client.schema.create_class({
+        "class": class_name,
+        "vectorizer": "none",
+        "properties": [{"name": "content", "dataType": ["text"]}],
+    })
+
+    vectors = model.encode([tokenize(doc) for doc in documents])
+    client.batch.configure(batch_size=100)
+    with client.batch as batch:
+        for document, vector in zip(documents, vectors):
+            batch.add_data_object({"content": document}, class_name, vector=vector)
+    return {
+        "chunks": len(documents),
+        "chars": sum(len(doc) for doc in documents),
+        "vector_bytes": len(documents) * vectors.shape[1] * 4,
+    }
+
+
+def weaviate_millis(headers):
+    """The Weaviate stage duration reported by context-retrieval's Server-Timing header."""
+    match = re.search(r"(?:^|,\s*)weaviate;dur=([\d.]+)", headers.get("server-timing", ""))
+    return float(match.group(1)) if match else None
+
+
+def percentile(values, q):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(q * (len(ordered) - 1))))]
+
+
+def evaluate(retrieval_url, class_name, questions, alpha, ks, tokenizer):
+    """Sends every question once per k with `limit=k`, so each row's latency is measured at its own limit."""
+    per_k = {k: {"recall": [], "rr": [], "tokens": [], "latency": [], "weaviate": []} for k in ks}
+
+    for q in questions:
+        for k in ks:
+            start = time.perf_counter()
+            response = requests.post(retrieval_url, json={
+                "query": q["question"], "limit": k, "alpha": alpha, "collection": class_name,
+            })
+            per_k[k]["latency"].append((time.perf_counter() - start) * 1000)
+            response.raise_for_status()
+            if weaviate_millis(response.headers) is not None:
+                per_k[k]["weaviate"].append(weaviate_millis(response.headers))
+
+            context = response.json()["context"]
+            docs = context.split(CONTEXT_SEPARATOR) if context else []
+            cited = []
+            for doc in docs:
+                match = CITATION_PATTERN.search(doc)
+                cited.append(normalize_article(match.group(1)) if match else None)
+
+            found = q["articles"].intersection(cited)
+            first = next((rank for rank, article in enumerate(cited, start=1) if article in q["articles"]), None)
+            per_k[k]["recall"].append(len(found) / len(q["articles"]))
+            per_k[k]["rr"].append(1 / first if first else 0.0)
+            per_k[k]["tokens"].append(len(tokenizer(context)["input_ids"]))
+
+    rows = []
+    for k in ks:
+        stats = per_k[k]
+        rows.append({
+            "alpha": alpha,
+            "k": k,
+            "recall": statistics.mean(stats["recall"]),
+            "mrr": statistics.mean(stats["rr"]),
+            "context_tokens": statistics.mean(stats["tokens"]),
+            "latency_p50_ms": percentile(stats["latency"], 0.5),
+            "latency_p95_ms": percentile(stats["latency"], 0.95),
+            "weaviate_p50_ms": percentile(stats["weaviate"], 0.5) if stats["weaviate"] else None,
+        })
+    return rows
+
+
+def print_table(rows):
+    header = f"{'size':>5} {'ovl':>4} {'alpha':>5} {'k':>3} {'recall':>7} {'mrr':>6} {'ctx_tok':>8} {'p50ms':>7} {'p95ms':>7} {'chunks':>6} {'idx_chars':>9}"
+    print(header)
+    print("-" * len(header))
+    for r in rows:
+        print(f"{r['chunk_size']:>5} {r['overlap']:>4} {r['alpha']:>5.2f} {r['k']:>3} {r['recall']:>7.3f} {r['mrr']:>6.3f} "
+              f"{r['context_tokens']:>8.0f} {r['latency_p50_ms']:>7.1f} {r['latency_p95_ms']:>7.1f} "
+              f"{r['chunks']:>6} {r['chars']:>9}")
+
+
+def recommend(rows, tolerance):
+    """Cheapest row (fewest context tokens, then smallest index) within `tolerance` of the best recall."""
+    best = max(r["recall"] for r in rows)
+    candidates = [r for r in rows if r["recall"] >= best - tolerance]
+    return min(candidates, key=lambda r: (r["context_tokens"], r["chars"], r["latency_p50_ms"]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--questions", required=True, help="labelled question set (JSONL)")
+    parser.add_argument("--pdf", default="RAG_data.pdf")
+    parser.add_argument("--extraction-method", default="fitz", choices=["fitz", "pypdf2"])
+    parser.add_argument("--weaviate-url", default="http://localhost:8085")
+    parser.add_argument("--retrieval-url", default="http://localhost:8005/retrieve-context")
+    parser.add_argument("--chunk-sizes", default="400,600,800")
+    parser.add_argument("--overlaps", default="0,100,300")
+    parser.add_argument("--alphas", default="0.25,0.5,0.75")
+    parser.add_argument("--ks", default="3,5,8")
+    parser.add_argument("--tokenizer", default="deepseek-ai/DeepSeek-R1-Distill-Qwen-7B",
+                        help="tokenizer used to count context tokens")
+    parser.add_argument("--tolerance", type=float, default=0.02,
+                        help="recall the recommended configuration may give up against the best one")
+    parser.add_argument("--output", default="retrieval_eval.json")
+    parser.add_argument("--keep-indexes", action="store_true", help="keep the Eval_* classes afterwards")
+    args = parser.parse_args()
+
+    questions = load_questions(args.questions)
+    ks = sorted(parse_list(args.ks, int))
+    client = weaviate.Client(args.weaviate_url)
+    model = SentenceTransformer("dangvantuan/vietnamese-embedding", device="cpu")
+    tokenizer = AutoTokenizer.from_pretrained(args.tokenizer)
+    raw_text = extract_text(args.pdf, args.extraction_method)
+
+    rows = []
+    created = []
+    try:
+        for chunk_size in parse_list(args.chunk_sizes, int):
+            for overlap in parse_list(args.overlaps, int):
+                if overlap >= chunk_size:
+                    continue
+                class_name = f"Eval_{chunk_size}_{overlap}"
+                documents = to_documents(build_chunks(raw_text, chunk_size, overlap))
+                index_stats = build_index(client, model, class_name, documents)
+                created.append(class_name)
+                print(f"Built {class_name}: {index_stats}")
+
+                for alpha in parse_list(args.alphas, float):
+                    for row in evaluate(args.retrieval_url, class_name, questions, alpha, ks, tokenizer):
+                        rows.append({"chunk_size": chunk_size, "overlap": overlap, **row, **index_stats})
+    finally:
+        if not args.keep_indexes:
+            for class_name in created:
+                client.schema.delete_class(class_name)
+
+    print_table(rows)
+    choice = recommend(rows, args.tolerance)
+    print(f"\nCheapest configuration within {args.tolerance} recall of the best: "
+          f"chunk_size={choice['chunk_size']} overlap={choice['overlap']} alpha={choice['alpha']} limit={choice['k']} "
+          f"(recall={choice['recall']:.3f}, mrr={choice['mrr']:.3f}, context_tokens={choice['context_tokens']:.0f})")
+
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump({"questions": len(questions), "rows": rows, "recommended": choice}, f, ensure_ascii=False, indent=4)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,10 +1,15 @@
 from fastapi import FastAPI, Request
 from pydantic import BaseModel
+from typing import List
 import torch
 from transformers import AutoModel, AutoTokenizer
 import uvicorn
 
+from diagnostics import ServerTimingMiddleware, install_debug_routes, stage
+
 app = FastAPI()
+app.add_middleware(ServerTimingMiddleware)
+install_debug_routes(app)
 
 model_name = "dangvantuan/vietnamese-embedding"
 tokenizer = AutoTokenizer.from_pretrained(model_name)
@@ -13,15 +18,38 @@ model = AutoModel.from_pretrained(model_name)
 class TextRequest(BaseModel):
     text: str
 
+class BatchTextRequest(BaseModel):
+    texts: List[str]
+
 def text2vec(text):
-    tokens_pt = tokenizer(text, padding=True, truncation=True, max_length=500, add_special_tokens=True, return_tensors="pt")
-    outputs = model(**tokens_pt)
-    return outputs[0].mean(0).mean(0).detach().cpu().numpy().tolist()
+    with stage("tokenize"):
+        tokens_pt = tokenizer(text, padding=True, truncation=True, max_length=500, add_special_tokens=True, return_tensors="pt")
+    with stage("forward"):
+        outputs = model(**tokens_pt)
+    with stage("pooling"):
+        return outputs[0].mean(0).mean(0).detach().cpu().numpy().tolist()
+
+def texts2vecs(texts):
+    """Batched text2vec: one padded forward pass, mean over each text's own tokens."""
+    with stage("tokenize"):
+        tokens_pt = tokenizer(texts, padding=True, truncation=True, max_length=500, add_special_tokens=True, return_tensors="pt")
+    with stage("forward"), torch.no_grad():
+        outputs = model(**tokens_pt)
+    with stage("pooling"):
+        mask = tokens_pt["attention_mask"].unsqueeze(-1).to(outputs[0].dtype)
+        vectors = (outputs[0] * mask).sum(1) / mask.sum(1)
+        return vectors.cpu().numpy().tolist()
 
 @app.post("/vectorize")
 async def vectorize(request: TextRequest):
     vector = text2vec(request.text)
     return {"vector": vector}
 
+@app.post("/vectorize-batch")
+async def vectorize_batch(request: BatchTextRequest):
+    if not request.texts:
+        return {"vectors": []}
+    return {"vectors": texts2vecs(request.texts)}
+
 if __name__ == '__main__':
     uvicorn.run(app, host="0.0.0.0", port=5000)